@@ -10,45 +10,402 @@ class SampleProgress:
         self.second_pos = 0.0
         self.channel = channel
         
-    def inc(self):
-        self.sample_pos += 1
+    def inc(self, count = 1):
+        self.sample_pos += count
         #errlog(self.sample_pos)
         
         second_pos = float(self.sample_pos) / self.sample_rate
         if second_pos > self.second_pos + self.second_width:
             self.second_pos = int(second_pos / self.second_width) * self.second_width
-            errlog("Generated %.1f seconds on channel %i." % (self.second_pos, self.channel))
+            errlog("Generated %.1f seconds on channel %s." % (self.second_pos, self.channel))
 
-def perform(q, filename, sample_rate, sample_depth, sample_packing, channel):
+def render(filename, sample_rate, sample_depth, sample_packing, channel = None, block_size = 4096, engine = "time", start = 0, stop = None, midi_channels = None, bands = None):
+    """
+    Generate the samples of a midi file as blocks of floats.
+
+    With channel None both ears come from a single StereoSynthSampler as
+    (left, right) frames, otherwise only the given audio channel is rendered.
+    The "fft" engine renders by inverse FFT with a SpectralSynthSampler instead,
+    and the "multirate" engine renders low tones at decimated rates with a
+    MultirateSynthSampler, in the given bands or its own, one audio channel
+    at a time.  Its first latency samples are dropped, so that it lines up
+    with the other engines.
+    The "samples" engine renders one audio channel a partial and a sample at
+    a time with a PartialSynthSampler, as the time engine is checked against.
+
+    Only the samples from start up to stop are generated.  The time and fft
+    engines skip the samples before start, which must be one of the block
+    boundaries found by plan(), as must stop.  The time engine can also
+    render only the tones of the given midi channels, as a stem.
+    """
     import random
     global sampler
     random.seed(a=0)
+    # the tones are summed in the order of their ids, so number them afresh
+    SynthTone.synth_id = 0
     
-    p = SampleProgress(sample_rate, channel, 0.1)
+    p = SampleProgress(sample_rate, "stereo" if channel is None else channel, 0.1)
     
-    sampler = SynthSampler(channel, sample_rate, sample_depth, sample_packing)
-    zero_sample = sampler.packing.pack(0)
+    if engine == "fft":
+        sampler = SpectralSynthSampler(channel, sample_rate, sample_depth, sample_packing)
+    elif engine == "multirate":
+        sampler = MultirateSynthSampler(channel or 0, sample_rate, sample_depth, sample_packing, bands)
+    elif engine == "samples":
+        sampler = PartialSynthSampler(channel or 0, sample_rate, sample_depth, sample_packing)
+    elif channel is None:
+        sampler = StereoSynthSampler(sample_rate, sample_depth, sample_packing)
+    else:
+        sampler = SynthSampler(channel, sample_rate, sample_depth, sample_packing)
+    if midi_channels is not None:
+        if engine != "time":
+            raise ValueError("Only the time engine renders stems, not %s." % engine)
+        sampler.midi_channels = set(midi_channels)
     channels = Channels(filename, sampler)
+    late = getattr(sampler, "latency", 0)
 
+    # Render the spans between events as whole blocks, splitting exactly at
+    # the sample on which each event batch takes effect.
     i = 0
     while True:
         channels.updateTime(float(i) / sample_rate)
-        sample = sampler.sample(i)
-        q.put(sample)
-        p.inc()
-        if not channels.remaining() and not sampler.remaining() and sample == zero_sample:
+
+        end = channels.nextEventSample(sample_rate)
+        if end is None or end > i + block_size:
+            end = i + block_size
+
+        if i < start:
+            # walk the events, envelopes and cycles up to the start without
+            # synthesis, but render the last block before it into the delay lines
+            end = min(end, start)
+            if start - i <= block_size:
+                sampler.render_block(i, end - i)
+            else:
+                sampler.skip_block(i, end - i)
+            i = end
+            continue
+        if stop is not None:
+            end = min(end, stop)
+
+        values = sampler.render_block(i, end - i)
+        finishing = not channels.remaining() and not sampler.remaining()
+        if finishing:
+            signed = sampler.signed_values(values)
+            silent = (signed.reshape(len(signed), -1) == 0).all(axis=1).nonzero()[0]
+            if len(silent):
+                values = values[:silent[0] + 1]
+        if late:
+            # the filters' look ahead, which the rest of the piece follows
+            trim = min(late, len(values))
+            values = values[trim:]
+            late -= trim
+
+        if len(values):
+            yield values
+            p.inc(len(values))
+        if (finishing and len(silent)) or end == stop:
             break
 
-        i += 1
+        i = end
 
-    q.put(None)
-    
+    errlog("Culled %i partials and retired %i tones." % (sampler.bank.culled, sampler.retirements))
+    bank = sampler.bank
+    errlog("Merged %i of %i audible partials into coincident ones (%.1f%%)." % (bank.merged, bank.rendered, 100.0 * bank.merged / max(bank.rendered, 1)))
+    errlog("Built %i timbre templates for %i tones." % (sampler.template_misses, sampler.template_misses + sampler.template_hits))
+
+def plan(filename, sample_rate, sample_depth, sample_packing, block_size = 4096):
+    """
+    Walk a midi file without synthesis to find where its rendering can be split.
+
+    Returns the event samples before which nothing can be heard, the samples
+    before the last event at which render() starts each block, from any of
+    which it can start a stereo segment on a sampler that skipped the samples
+    before it, and a sample by which the rendering has finished.
+    """
+    import random
+    random.seed(a=0)
+    SynthTone.synth_id = 0
+    sampler = StereoSynthSampler(sample_rate, sample_depth, sample_packing)
+    channels = Channels(filename, sampler)
+
+    quiet = [0]
+    blocks = [0]
+    i = 0
     while True:
-        q.put(zero_sample)
-        p.inc()
+        # the blocks follow render(), so that the tones are culled at the same samples,
+        # and only those before the last event can start a segment, as render() stops
+        # at the first silent sample after it
+        if i and channels.remaining():
+            blocks.append(i)
+        if i and sampler.quiet(float(i) / sample_rate):
+            if not channels.remaining():
+                return quiet, blocks, i
+            if channels.nextEventSample(sample_rate) == i:
+                quiet.append(i)
+        channels.updateTime(float(i) / sample_rate)
+
+        end = channels.nextEventSample(sample_rate)
+        if end is None or end > i + block_size:
+            end = i + block_size
+        sampler.skip_block(i, end - i)
+        i = end
+
+def render_segment(segment):
+    "render the samples of a segment into a wave file that has been resized for them, and return where they ended"
+    from numpy.random import RandomState
+    from wavlib import encode, WaveMap
+    index, filename, wavfile, sample_rate, sample_depth, sample_packing, block_size, start, stop, dither, data_offset, frame_bytes = segment
+    out = WaveMap(wavfile, data_offset, frame_bytes)
+    dither = RandomState(index) if dither else None
+    frame = start
+    try:
+        for values in render(filename, sample_rate, sample_depth, sample_packing, None, block_size, "time", start, stop):
+            out.write_encoded(frame, encode(values, sample_depth, dither=dither))
+            frame += len(values)
+    finally:
+        out.close()
+    return frame
+
+def render_parallel(filename, wavfile, sample_rate, sample_depth, sample_packing, block_size = 4096, dither = False, processes = None):
+    """
+    Render a midi file in stereo across a pool of processes.
+
+    The piece is split at quiet samples found by plan() into a few segments
+    for each process, as evenly as the quiet samples allow.  Where there is
+    no quiet sample within half a segment of an even split, as all through
+    a piece that never falls silent, the segment starts at the nearest block
+    boundary instead, from the envelopes and cycles that render() walks up
+    to it, which costs its process a few percent of rendering the samples
+    before it.  Each segment is rendered as render() would from its start,
+    and written straight to its frames of the wave file, which is sized to
+    the end found by plan() and trimmed to where the last segment ended.
+    """
+    import time
+    from bisect import bisect_left
+    from multiprocessing import Pool, cpu_count
+    from wavlib import WaveWriter
+
+    begin = time.time()
+    processes = processes or cpu_count()
+    quiet, blocks, length = plan(filename, sample_rate, sample_depth, sample_packing, block_size)
+
+    def nearest(samples, target):
+        j = bisect_left(samples, target)
+        return min(samples[max(j - 1, 0):j + 1], key=lambda q: abs(q - target))
+
+    starts = []
+    sounding = 0
+    pieces = processes * 4
+    for k in range(pieces):
+        # the quiet sample nearest each even split, or else the block boundary nearest it
+        target = length * k / pieces
+        start = nearest(quiet, target)
+        if abs(start - target) * 2 > length / pieces:
+            start = nearest(blocks, target)
+            sounding += start not in starts
+        if start not in starts:
+            starts.append(start)
+    starts.sort()
+    stops = starts[1:] + [None]
+    errlog("Planned %i segments, %i of them starting while the piece sounds, in %.2f seconds." % (len(starts), sounding, time.time() - begin))
+    if len(starts) == 1:
+        errlog("The piece is too short to split, so it renders as one segment.")
+
+    out = WaveWriter(wavfile, sample_rate, 2, sample_depth)
+    out.resize(length)
+    segments = [
+        (index, filename, wavfile, sample_rate, sample_depth, sample_packing, block_size, start, stop, dither, out.data_offset, out.frame_bytes)
+        for index, (start, stop) in enumerate(zip(starts, stops))
+    ]
+    pool = Pool(processes)
+    try:
+        # the longest segments first, so that none is left running alone at the end
+        order = sorted(range(len(segments)), key=lambda index: starts[index] - (stops[index] or length))
+        ends = dict(zip(order, pool.map(render_segment, [segments[index] for index in order], 1)))
+    finally:
+        pool.close()
+        pool.join()
+    out.resize(ends[len(segments) - 1])
+    out.close()
+    errlog("Rendered %i segments on %i processes in %.2f seconds." % (len(segments), processes, time.time() - begin))
+
+def active_channels(filename):
+    "the midi channels that a midi file plays notes on"
+    active = set()
+    for track in Midi(filename).tracks:
+        for event in track.contents.events:
+            event = event.event
+            if event.__class__ is ChannelEvent and event.event.__class__ is ChannelEvent.NoteOn and event.event.velocity:
+                active.add(event.event.midi_channel)
+    return sorted(active)
+
+def render_stem(filename, settings):
+    "render the stem of a midi file that a stem worker was asked for"
+    return render(
+        filename,
+        settings["sample_rate"],
+        settings["sample_depth"],
+        str(settings["sample_packing"]),
+        None,
+        settings["block_size"],
+        "time",
+        midi_channels=settings["midi_channels"],
+    )
+
+def render_stems(filename, wavfile, sample_rate, sample_depth, sample_packing, groups = None, workers = None, directory = None, block_size = 4096):
+    """
+    Render a midi file as stereo stems of groups of midi channels, and mix them.
+
+    Each group of midi channels, by default each channel that plays notes,
+    is rendered by one of the stem workers at the addresses in workers, or
+    by as many local workers as there are cores, each of which is asked for
+    one stem at a time.  The stems are kept as
+    float wave files in directory, by default next to wavfile, each with
+    the settings it was rendered with and a digest of the midi file beside
+    it, and a stem whose settings and midi file are unchanged is mixed
+    again without rendering it.
+    """
+    import hashlib, json, os, threading, time
+    from collections import deque
+    from multiprocessing import cpu_count
+    from stemlib import fetch_stem, local_workers, mix
+    from wavlib import WaveWriter
+
+    begin = time.time()
+    groups = groups or [[midi_channel] for midi_channel in active_channels(filename)]
+    directory = directory or wavfile + ".stems"
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, "rb") as f:
+        midi = f.read()
+    digest = hashlib.sha1(midi).hexdigest()
+    settings = [
+        {
+            "sample_rate": sample_rate,
+            "sample_depth": sample_depth,
+            "sample_packing": sample_packing,
+            "block_size": block_size,
+            "midi_channels": group,
+        }
+        for group in groups
+    ]
+    stems = [
+        os.path.join(directory, "stem-%s-%i-%i-%i.wav" % ("+".join(str(midi_channel) for midi_channel in group), sample_rate, sample_depth, block_size))
+        for group in groups
+    ]
+
+    def recorded(stem):
+        "the settings and midi digest that a stem was rendered with, or None"
+        try:
+            with open(stem + ".json") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+    stale = [
+        index for index, stem in enumerate(stems)
+        if not os.path.exists(stem) or recorded(stem) != dict(settings[index], midi=digest)
+    ]
+
+    processes = []
+    if stale and not workers:
+        processes, workers = local_workers(min(cpu_count(), len(stale)), render_stem)
+    try:
+        failures = []
+        pending = deque(stale)
+        def fetch(address):
+            # a worker renders each request in a process of its own, so it is
+            # only sent the next stem once it has finished the last
+            while pending and not failures:
+                try:
+                    index = pending.popleft()
+                except IndexError:
+                    break
+                try:
+                    frames = fetch_stem(address, midi, settings[index], stems[index], sample_rate)
+                    with open(stems[index] + ".json", "w") as f:
+                        json.dump(dict(settings[index], midi=digest), f)
+                    errlog("Rendered %i frames of %s on %s:%i." % (frames, stems[index], address[0], address[1]))
+                except Exception as e:
+                    failures.append(e)
+
+        threads = [threading.Thread(target=fetch, args=(address,)) for address in workers[:len(stale)]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for process in processes:
+            process.terminate()
+    if failures:
+        # so that a partly written stem is not taken for a rendered one
+        for index in stale:
+            for path in (stems[index], stems[index] + ".json"):
+                if os.path.exists(path):
+                    os.remove(path)
+        raise failures[0]
+    errlog("Rendered %i of %i stems in %.2f seconds." % (len(stale), len(stems), time.time() - begin))
+
+    out = WaveWriter(wavfile, sample_rate, 2, sample_depth)
+    peak, clipped = mix(stems, out)
+    out.close()
+    errlog("Mixed %i stems with a peak of %.3f and %i clipped samples." % (len(stems), peak, clipped))
+
+# how far below the signal each engine's RMS difference from the time engine must stay, in dB
+compare_bounds = {"fft": 12.0, "multirate": 40.0}
+# the largest difference from the time engine that each engine may make at any sample,
+# which for "samples" is about 1e-9 a second of a tone but for the wavetables of held tones
+compare_peaks = {"samples": 2e-6}
+
+def compare(filename, sample_rate, sample_depth, sample_packing, block_size = 4096, engine = "fft", bands = None):
+    """
+    Render a midi file with the time engine and another and report their timings and how far apart they are.
+
+    Returns whether the difference is within the engine's bound.
+    """
+    import numpy, time
+    # the multirate and samples engines only render one audio channel
+    channel = 0 if engine in ("multirate", "samples") else None
+    results = {}
+    for name in ("time", engine):
+        begin = time.time()
+        results[name] = numpy.concatenate(list(render(filename, sample_rate, sample_depth, sample_packing, channel, block_size, name, bands=bands)))
+        errlog("The %s engine took %.2f seconds." % (name, time.time() - begin))
+
+    reference, other = results["time"], results[engine]
+    length = min(len(reference), len(other))
+    difference = reference[:length] - other[:length]
+    peak = abs(difference).max()
+    rms = numpy.sqrt((difference ** 2).mean())
+    signal = numpy.sqrt((reference[:length] ** 2).mean())
+    below = 20 * numpy.log10(signal / rms) if rms else float("inf")
+    errlog("Peak difference %.3g, RMS difference %.3g (%.1f dB below the signal)." % (peak, rms, below))
+    if below < compare_bounds.get(engine, 0.0):
+        errlog("The %s engine is further from the time engine than its bound of %.1f dB." % (engine, compare_bounds[engine]))
+        return False
+    if peak > compare_peaks.get(engine, float("inf")):
+        errlog("The %s engine is further from the time engine than its peak of %.3g." % (engine, compare_peaks[engine]))
+        return False
+    return True
+
+def perform(ring, filename, sample_rate, sample_depth, sample_packing, channel, block_size = 4096, dither = False, engine = "time", bands = None):
+    from numpy.random import RandomState
+    from wavlib import encode
+    dither = RandomState(channel) if dither else None
+    try:
+        for values in render(filename, sample_rate, sample_depth, sample_packing, channel, block_size, engine, bands=bands):
+            ring.write(encode(values, sample_depth, dither=dither))
+    finally:
+        ring.close()
 
 if __name__ == '__main__':
     import sys
+    if sys.argv[1] == "serve":
+        # a stem worker listening on argv[2] as host:port, or as a port on this host
+        # alone; it renders for anyone who can reach it, so only listen on a trusted network
+        from stemlib import serve
+        host, port = sys.argv[2].rsplit(":", 1) if ":" in sys.argv[2] else ("127.0.0.1", sys.argv[2])
+        serve((host, int(port)), render_stem)
+        sys.exit()
+
     midifile = sys.argv[1]
     wavfile = sys.argv[2]
     
@@ -60,55 +417,89 @@ if __name__ == '__main__':
     #sample_packing = "h"
     sample_packing = "i"
 
-    from multiprocessing import Process, Queue
-    from collections import deque
+    dither = False
+    #dither = True
+
+    # "stereo" renders both ears in this process, "split" renders each ear in its own process,
+    # "parallel" renders segments of the piece in a pool of processes,
+    # "stems" renders groups of midi channels in stem workers and mixes them,
+    # and "compare" renders with the time engine and another and reports the difference
+    mode = sys.argv[3] if len(sys.argv) > 3 else "stereo"
+    # "time" sums sines a block at a time, "fft" overlap-adds inverse FFTs,
+    # "multirate" sums low tones at lower rates and upsamples them,
+    # and "samples" renders each partial a sample at a time to check the time engine by
+    engine = sys.argv[4] if len(sys.argv) > 4 else "time"
+    # the multirate engine's bands at argv[5], as decimations like 1,2,4,8
+    bands = [int(decimation) for decimation in sys.argv[5].split(",")] if engine == "multirate" and len(sys.argv) > 5 else None
+
+    from wavlib import WaveWriter
+
+    if mode == "compare":
+        sys.exit(0 if compare(midifile, sample_rate, sample_depth, sample_packing, 4096, "fft" if engine == "time" else engine, bands) else 1)
+
+    if mode == "parallel":
+        # rendered in segments by a pool of processes, as many as argv[5] or the cores
+        if engine != "time":
+            raise ValueError("Only the time engine renders in segments, not %s." % engine)
+        render_parallel(midifile, wavfile, sample_rate, sample_depth, sample_packing, 4096, dither, int(sys.argv[5]) if len(sys.argv) > 5 else None)
+        sys.exit()
+
+    if mode == "stems":
+        # stems of argv[6] as groups like 0+1,9 or of each channel, rendered by the
+        # workers at argv[5] as host:port,host:port or by local ones, then mixed
+        if engine != "time":
+            raise ValueError("Only the time engine renders stems, not %s." % engine)
+        workers = [(host, int(port)) for host, port in (address.rsplit(":", 1) for address in sys.argv[5].split(","))] if len(sys.argv) > 5 and sys.argv[5] else None
+        groups = [[int(midi_channel) for midi_channel in group.split("+")] for group in sys.argv[6].split(",")] if len(sys.argv) > 6 else None
+        render_stems(midifile, wavfile, sample_rate, sample_depth, sample_packing, groups, workers)
+        sys.exit()
+
+    if mode == "stereo" and engine in ("multirate", "samples"):
+        # each ear needs its own sampler
+        mode = "split"
+
+    if mode == "stereo":
+        out = WaveWriter(wavfile, sample_rate, 2, sample_depth, dither=dither)
+        for values in render(midifile, sample_rate, sample_depth, sample_packing, None, 4096, engine):
+            out.write(values)
+        out.close()
+        sys.exit()
+
+    from multiprocessing import Process
     from midilib import errlog
-    from struct import Struct
+    from ringlib import RingBuffer, interleave
 
-    left_q = Queue()
-    right_q = Queue()
+    left_ring = RingBuffer()
+    right_ring = RingBuffer()
 
-    left_process =  Process(target=perform, args=(left_q, midifile, sample_rate, sample_depth, sample_packing, 0))
-    right_process = Process(target=perform, args=(right_q, midifile, sample_rate, sample_depth, sample_packing, 1))
+    left_process =  Process(target=perform, args=(left_ring, midifile, sample_rate, sample_depth, sample_packing, 0, 4096, dither, engine, bands))
+    right_process = Process(target=perform, args=(right_ring, midifile, sample_rate, sample_depth, sample_packing, 1, 4096, dither, engine, bands))
     
     try:
         left_process.start()
         right_process.start()
 
-        out = open(wavfile + ".raw", "wb")
+        out = WaveWriter(wavfile, sample_rate, 2, sample_depth)
         
+        width = sample_depth / 8
+        chunk = 1 << 16
         i = 0
-        left_finished = False
-        right_finished = False
-        
-        left, right = left_q.get(), right_q.get()
-        while not left_finished or not right_finished:
-            if left is None:
-                left_finished = True
-                left = left_q.get()
-            
-            if right is None:
-                right_finished = True
-                right = right_q.get()
-                    
-            out.write(left + right)
-            if i % 8192 == 0:
-                out.flush()
-                errlog("i = %i" % i)
+        while True:
+            left, right = left_ring.read(chunk), right_ring.read(chunk)
+            if not left and not right:
+                break
                 
-            i += 1
-            left, right = left_q.get(), right_q.get()
+            out.write_encoded(interleave([left, right], width))
+            i += max(len(left), len(right)) / width
+            errlog("i = %i" % i)
             
-        errlog("%r" % ([left, right]))
-        out.flush()
-        errlog("i = %i" % i)
         out.close()
     except KeyboardInterrupt:
-        left_process.terminate()
-        right_process.terminate()
+        pass
     finally:
+        # once nothing reads the rings the workers block on them, so stop them
+        # before waiting for them, which after the last block only cuts their logs
         left_process.terminate()
         right_process.terminate()
         left_process.join()
         right_process.join()
-
@@ -546,14 +546,33 @@ class Channels:
         return not self.q.empty()
             
     def updateTime(self, s):
-        delta = s - self.s
+        # measure from the last tempo change, so that the ticks do not depend
+        # on how often the time is updated
         self.s = s
-        self.t += delta * self.ticks_per_second()
+        self.t = self.tempo_t + (s - self.tempo_s) * self.ticks_per_second()
         
         self.q.update_time(self.t)
     
         self.pullEnqueuedEvents()
 
+    def nextEventSample(self, sample_rate):
+        "first sample index at which updateTime() will produce the next event, or None"
+        t = self.q.next_time()
+        if t is None:
+            return None
+
+        from math import ceil
+        tps = self.ticks_per_second()
+        ticks = lambda i: int(self.tempo_t + (float(i) / sample_rate - self.tempo_s) * tps)
+
+        # estimate, then settle on the sample with the same arithmetic as updateTime()
+        i = max(int(ceil((self.tempo_s + (t - self.tempo_t) / tps) * sample_rate)), 0)
+        while i > 0 and ticks(i - 1) >= t:
+            i -= 1
+        while ticks(i) < t:
+            i += 1
+        return i
+
     def pullEnqueuedEvents(self):
         self.updateEvents(self.q.event_batch())
 
@@ -635,6 +654,8 @@ class Channels:
         self.meta_channel = m.midi_channel
 
     def setTempo(self, m):
+        self.tempo_s = self.s
+        self.tempo_t = self.t
         self.tempo = m
         self.midi.head.setTempo(m.microseconds_per_beat)
         #print "ticks_per_second", self.midi.head.ticks_per_second
@@ -682,6 +703,8 @@ class Channels:
         
         self.s = 0.0
         self.t = 0.0
+        self.tempo_s = 0.0
+        self.tempo_t = 0.0
         
         self.on_notes = []
         self.last_tuning = None
@@ -794,6 +817,20 @@ class Note:
 	):
 		property_class = BlownPipeProperties
  
+	# 81 - 83 Lead, as single oscillators
+	if (
+		(program == 81)
+	):
+		property_class = SquareLeadProperties
+	if (
+		(program == 82)
+	):
+		property_class = SawtoothLeadProperties
+	if (
+		(program == 83)
+	):
+		property_class = TriangleLeadProperties
+ 
         self.tone = self.channel.sampler.newTone(self.channel.midi_channel, f, self.pan, seconds, None, property_class)
 
         self.ref_count = 0
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Copyright Ben Woolley 2010.
+All rights reserved.
+"""
+
+class RingBuffer:
+    """
+    Block transport from one worker process to one reader process.
+
+    The bytes live in an anonymous shared mmap, so forked workers write into
+    the same memory the reader reads from.  Only the running byte counts are
+    shared values, guarded by a condition that the writer signals when a block
+    is available and the reader signals when space is freed.  A writer that
+    gets ahead of the reader by the whole capacity waits, and close() marks
+    the end of the stream.
+    """
+
+    def __init__(self, capacity = 1 << 20):
+        import mmap
+        from multiprocessing import Condition, Value
+        self.capacity = capacity
+        self.data = mmap.mmap(-1, capacity)
+        self.written = Value("L", 0, lock=False)
+        self.read_count = Value("L", 0, lock=False)
+        self.closed = Value("b", 0, lock=False)
+        self.condition = Condition()
+
+    def write(self, block):
+        pos = 0
+        while pos < len(block):
+            with self.condition:
+                while self.written.value - self.read_count.value >= self.capacity:
+                    self.condition.wait()
+                space = self.capacity - (self.written.value - self.read_count.value)
+                start = self.written.value % self.capacity
+
+            # only this process writes to the free region, so copy outside the lock
+            count = min(space, len(block) - pos, self.capacity - start)
+            self.data[start:start + count] = block[pos:pos + count]
+            pos += count
+
+            with self.condition:
+                self.written.value += count
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed.value = 1
+            self.condition.notify_all()
+
+    def read(self, size):
+        "read size bytes, or whatever is left once the writer has closed; empty at the end"
+        size = min(size, self.capacity)
+        with self.condition:
+            while self.written.value - self.read_count.value < size and not self.closed.value:
+                self.condition.wait()
+            count = min(size, self.written.value - self.read_count.value)
+            start = self.read_count.value % self.capacity
+
+        first = min(count, self.capacity - start)
+        block = self.data[start:start + first] + self.data[0:count - first]
+
+        with self.condition:
+            self.read_count.value += count
+            self.condition.notify_all()
+        return block
+
+
+def interleave(blocks, width):
+    "interleave the samples of each channel's block into frames, padding short channels with silence"
+    import numpy
+    frames = max(len(block) for block in blocks) / width
+    out = numpy.zeros((frames, len(blocks), width), dtype=numpy.uint8)
+    for channel, block in enumerate(blocks):
+        samples = numpy.frombuffer(block, dtype=numpy.uint8).reshape(-1, width)
+        out[:len(samples), channel] = samples
+    return out.tobytes()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+Copyright Ben Woolley 2010.
+All rights reserved.
+"""
+
+import struct
+
+# A stem is requested by sending two messages, the settings as JSON and the
+# bytes of the midi file.  The worker answers with a message of 32 bit float
+# frames for each block it renders, an empty message once the stem is done,
+# and a JSON status of either the frames rendered or an error.  Every
+# message is its length as 4 bytes in network order followed by that many bytes.
+
+def send_message(sock, data):
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+def receive_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 16))
+        if not chunk:
+            raise EOFError("The connection closed %i bytes early." % size)
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def receive_message(sock):
+    size, = struct.unpack("!I", receive_exactly(sock, 4))
+    return receive_exactly(sock, size)
+
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+class StemHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        import json, os, tempfile, traceback
+        from wavlib import encode
+        settings = json.loads(receive_message(self.request))
+        handle, filename = tempfile.mkstemp(suffix=".mid")
+        frames = 0
+        try:
+            with os.fdopen(handle, "wb") as f:
+                f.write(receive_message(self.request))
+            for values in self.server.render(filename, settings):
+                send_message(self.request, encode(values, floating=True))
+                frames += len(values)
+            status = {"frames": frames}
+        except Exception:
+            status = {"error": traceback.format_exc()}
+        finally:
+            os.remove(filename)
+        send_message(self.request, b"")
+        send_message(self.request, json.dumps(status).encode("utf-8"))
+
+
+class StemServer(socketserver.ForkingMixIn, socketserver.TCPServer):
+    """
+    Renders stems for other hosts, each request in its own process.
+
+    render is called with the path of the midi file and the settings that
+    were sent, and generates the blocks of the stem as floats.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, address, render):
+        socketserver.TCPServer.__init__(self, address, StemHandler)
+        self.render = render
+
+
+def serve(address, render):
+    """
+    Render stems for whoever connects to address until interrupted.
+
+    There is no authentication: any peer that can reach the address has
+    its midi file rendered with the settings it sends.  So a worker should
+    listen on 127.0.0.1, or on a network whose hosts are all trusted.
+    """
+    server = StemServer(address, render)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def local_workers(count, render):
+    """
+    Start count stem servers on this host, each in its own process.
+
+    Returns the processes, to be terminated once the stems are in, and the
+    addresses they listen on.  They stand in for workers on other hosts.
+    """
+    from multiprocessing import Process
+    processes = []
+    addresses = []
+    for i in range(count):
+        # bound here, so that the address is known before the process starts
+        server = StemServer(("127.0.0.1", 0), render)
+        process = Process(target=server.serve_forever)
+        process.daemon = True
+        process.start()
+        server.server_close()
+        processes.append(process)
+        addresses.append(server.server_address)
+    return processes, addresses
+
+def fetch_stem(address, midi, settings, filename, sample_rate, channels = 2):
+    "have the worker at address render a stem of the midi file's bytes, and write it to a float wave file; returns the frames"
+    import json, socket
+    from wavlib import WaveWriter
+    sock = socket.create_connection(address)
+    out = WaveWriter(filename, sample_rate, channels, floating=True)
+    try:
+        send_message(sock, json.dumps(settings).encode("utf-8"))
+        send_message(sock, midi)
+        while True:
+            block = receive_message(sock)
+            if not block:
+                break
+            out.write_encoded(block)
+        status = json.loads(receive_message(sock).decode("utf-8"))
+    finally:
+        out.close()
+        sock.close()
+    if "error" in status:
+        raise RuntimeError("The worker at %s:%i failed to render %s:\n%s" % (address[0], address[1], filename, status["error"]))
+    return status["frames"]
+
+def mix(filenames, out, block_frames = 1 << 16):
+    """
+    Sum stems from disk into a WaveWriter, clipping the sum to [-1.0, 1.0].
+
+    Shorter stems are padded with silence.  Returns the peak of the sum
+    before clipping and how many of its samples were clipped.
+    """
+    import numpy
+    from wavlib import WaveReader
+    stems = [WaveReader(filename) for filename in filenames]
+    peak = 0.0
+    clipped = 0
+    try:
+        while True:
+            blocks = [stem.read(block_frames) for stem in stems]
+            frames = max(len(block) for block in blocks)
+            if not frames:
+                break
+            v = numpy.zeros((frames, out.channels))
+            for block in blocks:
+                v[:len(block)] += block
+            peak = max(peak, abs(v).max())
+            over = abs(v) > 1.0
+            clipped += int(over.sum())
+            out.write(numpy.clip(v, -1.0, 1.0))
+    finally:
+        for stem in stems:
+            stem.close()
+    return peak, clipped
@@ -7,20 +7,43 @@ All rights reserved.
 
 from tunelib import *
         
-class SimpleArpeggio(BaseTone, BaseSampler):
-    def __init__(self, rate, depth, packing, channel, tones, seconds):
-        BaseSampler.__init__(self, rate, depth, packing)
+class SimpleArpeggio(StereoSynthSampler):
+    def __init__(self, rate, depth, packing, tones, seconds):
+        StereoSynthSampler.__init__(self, rate, depth, packing)
 
         errlog(tones)
-        self.partials = []
+        self.stop = int(seconds * self.rate)
+        self.attacks = []
 
         start = 0.0
-        for tone in tones:
-            synth = SynthTone(None, tone, self.nyquist, channel, start, seconds)
+        for frequency in tones:
+            synth = self.newTone(0, frequency, 0.0, start, seconds, PluckedStringProperties)
+            synth.updateFrequency(frequency)
             errlog(synth.properties.__dict__)
-            self.partials.extend(synth.partials)
+            self.attacks.append((int(start * self.rate), synth))
             
             start += float(seconds) / 3 / len(tones)
+
+    def blocks(self, frame_count, block_size = 4096):
+        "frames as blocks of floats, split where each tone starts and where they all stop"
+        i = 0
+        for at, synth in self.attacks + [(self.stop, None)]:
+            at = min(at, frame_count)
+            while i < at:
+                n = min(at - i, block_size)
+                yield self.render_block(i, n)
+                i += n
+            
+            if synth is None:
+                for tone in self.tones.values():
+                    tone.release()
+            else:
+                synth.unrelease()
+
+        while i < frame_count:
+            n = min(frame_count - i, block_size)
+            yield self.render_block(i, n)
+            i += n
         
 
 """        
@@ -40,20 +63,20 @@ class SampleProgress:
         self.second_pos = 0.0
         self.channel = channel
         
-    def inc(self):
-        self.sample_pos += 1
+    def inc(self, count = 1):
+        self.sample_pos += count
         #errlog(self.sample_pos)
         
         second_pos = float(self.sample_pos) / self.sample_rate
         if second_pos > self.second_pos + self.second_width:
             self.second_pos = int(second_pos / self.second_width) * self.second_width
-            errlog("Generated %.1f seconds on channel %i." % (self.second_pos, self.channel))
+            errlog("Generated %.1f seconds on channel %s." % (self.second_pos, self.channel))
 
 
 
-def perform(q, tuner, chords, sample_rate, sample_depth, sample_packing, channel):
+def perform(out, tuner, chords, sample_rate, sample_depth, sample_packing):
 
-    p = SampleProgress(sample_rate, channel, 0.1)
+    p = SampleProgress(sample_rate, "stereo", 0.1)
 
     for bass, chord in chords:
         tuned = tuner()
@@ -64,19 +87,82 @@ def perform(q, tuner, chords, sample_rate, sample_depth, sample_packing, channel
                     
         errlog(tuned.noteFrequencies())
         
-        channel_sampler  = SimpleArpeggio(sample_rate, sample_depth, sample_packing, channel, [f for n, f in tuned.noteFrequencies()], seconds - (1.0/32))
+        sampler = SimpleArpeggio(sample_rate, sample_depth, sample_packing, [f for n, f in tuned.noteFrequencies()], seconds - (1.0/32))
         
-        for i in xrange(0, int(sample_rate * seconds)):
-            channel_sample = channel_sampler.sample(i)
-            #q.put((channel, channel_sample))
-            q.put(channel_sample)
-            p.inc()
+        for values in sampler.blocks(int(sample_rate * seconds)):
+            out.write(values)
+            p.inc(len(values))
             
 
-if __name__ == '__main__':
-    from multiprocessing import Process, Queue
-    from collections import deque
+def compare_searches(chords, max_i, searches = ("nested", "crawl", "best", "bound", "dynamic")):
+    """
+    Tune each chord by each search, and report the cost of the solutions and the nodes expanded to find them.
+
+    Returns whether every search found the same cost and ratios as the
+    first.
+    """
+    import time
+    totals = dict((search, [0, 0.0]) for search in searches)
+    same = True
+    for bass, chord in chords:
+        results = []
+        first = None
+        for search in searches:
+            tuned = Tuner(search=search)
+            for note in chord:
+                tuned.addNote(bass - 24 + note)
+            begin = time.time()
+            tuned.tune(1000, max_i)
+            totals[search][0] += tuned.expanded
+            totals[search][1] += time.time() - begin
+            solution = (tuned.closest(tuned.solution), [str(ratio) for ratio in tuned.solution.list_ratios()])
+            if first is None:
+                first = solution
+            results.append("%s cost %i after %i nodes" % (search, solution[0], tuned.expanded))
+            if solution != first:
+                results[-1] += " with OTHER RATIOS %s" % " ".join(solution[1])
+                same = False
+        errlog("%s: %s" % (chord, ", ".join(results)))
+    for search in searches:
+        errlog("%s expanded %i nodes in %.2f seconds." % (search, totals[search][0], totals[search][1]))
+    return same
+
+def compare_processes(chords, counts = (1, 2, 4, 8)):
+    """
+    Tune the chords by the bound search, and then by the parallel search in each count of processes, and report the speedup over the bound search.
+
+    Each count is also run with every search started in the pool, however
+    small.  Returns whether every parallel search found the same solutions
+    as the bound search.
+    """
+    import time
+    def tune_all(search, processes = None, serial_nodes = Tuner.serial_nodes):
+        begin = time.time()
+        solutions = []
+        for bass, chord in chords:
+            tuned = Tuner(search=search)
+            tuned.processes = processes
+            tuned.serial_nodes = serial_nodes
+            for note in chord:
+                tuned.addNote(bass - 24 + note)
+            tuned.tune()
+            solutions.append(tuned.solution.list_ratios())
+        return solutions, time.time() - begin
 
+    serial, serial_seconds = tune_all("bound")
+    errlog("bound tuned %i chords in %.2f seconds." % (len(chords), serial_seconds))
+    same = True
+    for count in counts:
+        for serial_nodes in (Tuner.serial_nodes, 0):
+            solutions, seconds = tune_all("parallel", count, serial_nodes)
+            errlog("parallel in %i processes%s tuned them in %.2f seconds, %.2f times as fast, %s." % (
+                count, "" if serial_nodes else " and always in the pool", seconds, serial_seconds / seconds,
+                "with the same solutions" if solutions == serial else "with OTHER SOLUTIONS"))
+            same = same and solutions == serial
+    return same
+
+
+if __name__ == '__main__':
     chords = [
         (0, [0, 12, 24, 36, 48]),
         (24, [0, 4, 7, 12, 16]),
@@ -133,6 +219,17 @@ if __name__ == '__main__':
 
     max_i = 30000
 
+    if tuning == "search":
+        # chords with equally cheap solutions, which every search must break as the crawl does
+        ties = [
+            (6, [3, 9, 10, 11, 21, 34]),
+            (13, [22, 23, 24, 25, 37]),
+            (16, [3, 7, 18, 29, 30, 31, 34]),
+        ]
+        sys.exit(0 if compare_searches(chords + ties, max_i) else 1)
+    if tuning == "processes":
+        sys.exit(0 if compare_processes(chords) else 1)
+
     performance_tuner = {
         "auto": Tuner,
         "even": EvenTuner,
@@ -142,34 +239,13 @@ if __name__ == '__main__':
         "bech": BechsteinTuner,        
     }[tuning]
 
-    #q = Queue()
-    #left_d  = deque()
-    #right_d = deque()
-    left_q = Queue()
-    right_q = Queue()
-
-    left_process =  Process(target=perform, args=(left_q, performance_tuner, chords, sample_rate, sample_depth, sample_packing, 0))
-    right_process = Process(target=perform, args=(right_q, performance_tuner, chords, sample_rate, sample_depth, sample_packing, 1))
+    from wavlib import WaveWriter
 
+    out = WaveWriter(tuning + ".wav", sample_rate, 2, sample_depth)
     try:
-        left_process.start()
-        right_process.start()
-
-        out = open(tuning + ".raw", "wb")
-
-        for i in xrange(0, int(sample_rate * seconds * len(chords))):
-            out.write(left_q.get() + right_q.get())
-            if i % 1024 == 0:
-                out.flush()
-                errlog("i = %i" % i)
-                    
-        out.close()
-    except KeyboardInterrupt:
-        left_process.terminate()
-        right_process.terminate()
+        perform(out, performance_tuner, chords, sample_rate, sample_depth, sample_packing)
     finally:
-        left_process.join()
-        right_process.join()
+        out.close()
     
     """
     for i in xrange(0, int(sample_rate * seconds * 2)):
@@ -436,10 +436,71 @@ class EqualIntervals:
 class SearchComplete: pass
 class MaxIterationsReached: pass
 
+shared_incumbent = None
+
+def share_incumbent(incumbent):
+    "set up a process of the pool of Tuner.parallel_bound() with the incumbent that they share"
+    global shared_incumbent
+    shared_incumbent = incumbent
+
+def search_branch(branch):
+    """
+    Search one branch for Tuner.parallel_bound().
+
+    Returns the cost and crawl path of the branch's first cheapest
+    solution and the index of the ratio it takes for each interval, or None
+    for all three if the branch was cut, and the nodes expanded below the
+    branch.
+    """
+    notes, sustain, notes_per_octave, max_octaves, path = branch
+    tuner = Tuner(sustain, notes_per_octave, max_octaves, "bound")
+    tuner.shared_incumbent = shared_incumbent
+    for note in notes:
+        tuner.addNote(note)
+    tuner.incumbent = float("inf")
+    tuner.incumbent_path = ()
+
+    node = tuner.branch_node(path)
+    expanded = tuner.expanded
+    if not tuner.promising(node):
+        return None, None, None, 0
+    for product in tuner.branch_and_bound(node):
+        pass
+    if not tuner.solutions:
+        return None, None, None, tuner.expanded - expanded
+    ratios = tuner.solutions[-1].list_ratios()
+    indices = [
+        [i for i, candidate in enumerate(interval.ratios) if candidate is ratio][0]
+        for interval, ratio in zip(tuner.list_intervals(), ratios)
+    ]
+    return tuner.incumbent, tuner.incumbent_path, indices, tuner.expanded - expanded
+
 class Tuner:
     _harmonic_cache = {}
 
-    def __init__(self, sustain = None, notes_per_octave = 12, max_octaves = 4):
+    # "crawl" crawls the ratio graph depth first for up to max_i solutions,
+    # "nested" crawls it as "crawl" does through a generator for each node,
+    # "best" expands the nodes best first until the cheapest solution is found,
+    # "bound" crawls it cheapest child first, cutting what cannot beat the best so far,
+    # "dynamic" solves each state of the fundamentals once, memoizing its cheapest completion,
+    # and "parallel" searches as "bound" does, across a pool of processes
+    search = "crawl"
+    # the processes of the "parallel" search, or None for one for each core
+    processes = None
+    # the nodes that the "parallel" search expands by itself first, in about
+    # the time that a pool of processes takes to start
+    serial_nodes = 2000
+    # the incumbent cost shared by the processes of the "parallel" search
+    shared_incumbent = None
+    # the nodes expanded after which branch_and_bound() gives up, or None
+    budget = None
+
+    def __init__(self, sustain = None, notes_per_octave = 12, max_octaves = 4, search = None):
+        if search:
+            self.search = search
+        self.expanded = 0
+        self.bounds = None
+        self.completions = {}
         self.sustain = sustain
         self.sustainMap = dict(self.sustain) if self.sustain else {}
         self.npo = float(notes_per_octave)
@@ -627,17 +688,30 @@ class Tuner:
             #self.fundamentals = set(self.parent.fundamentals) if self.parent else set()
             self.depth = parent_depth + 1
             self.ratio = ratio
+            # the sum of the fundamentals' denominators, as closest
+            self.cost = self.parent.cost if self.parent else 0
             if self.ratio:
                 fundamental = self.tuner.harmonics.getHarmonicNote(self.ratio.d) - self.parent.child_interval.bottom
                 if fundamental not in self.fundamentals:
                     self.fundamentals[fundamental] = self.ratio.d
+                    self.cost += self.ratio.d
             #print self.depth
             #print self.tuner.list_intervals()
             self.sustainCount = None
+            # the index of the child taken at each depth in the order the crawler takes them, set by Tuner.branch_children()
+            self.crawl_path = ()
             self.iterator = self.crawler()
         
-        def crawler(self):
+        def child_ratios(self):
+            """
+            The ratios of the next interval in the order the children are crawled, or None at a solution.
+
+            Where the top of the next interval is sustained, only the ratios
+            that keep it at its sustained pitch are given, if there are any.
+            Otherwise the ratios that bring no new fundamental come first.
+            """
             if len(self.tuner.list_intervals()) > self.depth:
+                self.tuner.expanded += 1
                 self.child_interval = self.tuner.list_intervals()[self.depth]
                 
                 if self.sustainCount is None:
@@ -694,10 +768,7 @@ class Tuner:
                     #import sys
                     #sys.exit()
                     
-                    for ratio in possibleRatios:
-                        child = self.tuner.IntervalNode(self.tuner, self, self.depth, ratio)
-                        for product in child.iterator:
-                            yield product
+                    return possibleRatios
                     
                 else:
                     
@@ -714,21 +785,26 @@ class Tuner:
                         else:
                             worse_ratios.append(ratio)
                     
-                    for ratio in better_ratios:
-                        child = self.tuner.IntervalNode(self.tuner, self, self.depth, ratio)
-                        for product in child.iterator:
-                            yield product
-                            
-                    for ratio in worse_ratios:
-                        child = self.tuner.IntervalNode(self.tuner, self, self.depth, ratio)
-                        for product in child.iterator:
-                            yield product
+                    return better_ratios + worse_ratios
                                             
             else:
                 self.child_interval = None
                 self.children = None
+                return None
+
+        def child_nodes(self, ratios):
+            for ratio in ratios:
+                yield self.tuner.IntervalNode(self.tuner, self, self.depth, ratio)
+
+        def crawler(self):
+            ratios = self.child_ratios()
+            if ratios is None:
                 self.tuner.solutions.append(self.tuner.Solution(self))
                 yield True
+            else:
+                for child in self.child_nodes(ratios):
+                    for product in child.iterator:
+                        yield product
             
             
         def indent(self):
@@ -781,6 +857,351 @@ class Tuner:
             else:
                 return False
     
+    def fundamental_bounds(self):
+        """
+        The fundamentals that the ratios of each interval could bring, and
+        for each depth the least denominator that a fundamental could be
+        brought with by an interval from that depth on.
+        """
+        if self.bounds is None:
+            intervals = self.list_intervals()
+            candidates = [
+                set(self.harmonics.getHarmonicNote(ratio.d) - interval.bottom for ratio in interval.ratios)
+                for interval in intervals
+            ]
+            cheapest = [{}]
+            for interval in reversed(intervals):
+                least = dict(cheapest[0])
+                for ratio in interval.ratios:
+                    fundamental = self.harmonics.getHarmonicNote(ratio.d) - interval.bottom
+                    least[fundamental] = min(least.get(fundamental, ratio.d), ratio.d)
+                cheapest.insert(0, least)
+            self.bounds = candidates, cheapest
+        return self.bounds
+
+    def lower_bound(self, node):
+        """
+        A cost that no solution below node comes in under.
+
+        Every remaining interval adds one of its fundamentals, which is free
+        if the node has it already, and otherwise costs at least the least
+        denominator it could be brought with, so the solutions cost at
+        least the most that any one remaining interval must add.
+        """
+        candidates, cheapest = self.fundamental_bounds()
+        least = cheapest[node.depth]
+        bound = 0
+        for fundamentals in candidates[node.depth:]:
+            bound = max(bound, min(0 if fundamental in node.fundamentals else least[fundamental] for fundamental in fundamentals))
+        return bound
+
+    def best_first(self):
+        """
+        Search the ratio graph best first for the cheapest solution by closest.
+
+        Nodes are expanded in order of the cost of their fundamentals plus
+        lower_bound(), which never overestimates, so the first solution to
+        come out of the queue is the cheapest.  Ties go to the node that the
+        crawler reaches first, so it is the solution that crawling the whole
+        graph would settle on.
+        """
+        from heapq import heappush, heappop
+        root = self.IntervalNode(self, None, -1, None)
+        queue = [(self.lower_bound(root), (), root)]
+        while queue:
+            cost, path, node = heappop(queue)
+            ratios = node.child_ratios()
+            if ratios is None:
+                return self.Solution(node)
+            for i, child in enumerate(node.child_nodes(ratios)):
+                heappush(queue, (child.cost + self.lower_bound(child), path + (i,), child))
+
+    def branch_and_bound(self, node):
+        """
+        Crawl the ratio graph below node, cutting what cannot beat the incumbent.
+
+        The children are crawled in order of the cost that each adds, and a
+        node is cut once its cost plus lower_bound() reaches the cost of the
+        incumbent, the cheapest solution so far, unless it is as cheap and
+        the crawler would reach it first.  Each solution that is reached
+        becomes the incumbent and is yielded, so the crawl is over when the
+        solution that crawling the whole graph would settle on has been
+        found and every other node cut, or when the budget of expanded nodes
+        has run out, which is yielded as MaxIterationsReached.
+        """
+        if self.budget is not None and self.expanded >= self.budget:
+            yield MaxIterationsReached
+            return
+        children = self.branch_children(node)
+        if children is None:
+            self.incumbent = node.cost
+            self.incumbent_path = node.crawl_path
+            if self.shared_incumbent is not None:
+                with self.shared_incumbent.get_lock():
+                    self.shared_incumbent.value = min(self.shared_incumbent.value, node.cost)
+            # it beats every solution before it, even one as cheap, which update_solution() would keep
+            self.solutions = [self.Solution(node)]
+            yield True
+            return
+
+        for child in children:
+            if self.promising(child):
+                for product in self.branch_and_bound(child):
+                    yield product
+
+    def branch_children(self, node):
+        "the children of node in the order branch_and_bound() crawls them, or None at a solution"
+        ratios = node.child_ratios()
+        if ratios is None:
+            return None
+        children = list(node.child_nodes(ratios))
+        for index, child in enumerate(children):
+            child.crawl_path = node.crawl_path + (index,)
+        return sorted(children, key=lambda child: child.cost)
+
+    def branch_node(self, path):
+        "the node that branch_and_bound() reaches by taking the child at each index of path"
+        node = self.IntervalNode(self, None, -1, None)
+        for index in path:
+            node = self.branch_children(node)[index]
+        return node
+
+    def promising(self, node):
+        """
+        Whether node could lead to a solution cheaper than the incumbent, or
+        as cheap and ahead of it in the crawl.
+
+        The incumbent shared by other processes only cuts nodes that must
+        cost more, so a process still finds the first of its cheapest
+        solutions when another has found one as cheap.
+        """
+        bound = node.cost + self.lower_bound(node)
+        return (bound, node.crawl_path) < (self.incumbent, self.incumbent_path) and (self.shared_incumbent is None or bound <= self.shared_incumbent.value)
+
+    def parallel_bound(self):
+        """
+        Search the branches of the ratio graph in a pool of processes.
+
+        A search that branch_and_bound() finishes within serial_nodes is
+        over before a pool could start, so it is searched that far first.
+        Otherwise the graph is split at its first one or two levels, into
+        a few branches for each process, which each search as
+        branch_and_bound() would with an incumbent cost that they all
+        share, starting from the cheapest solution found so far.  Of the
+        cheapest solutions of the branches, the first in the crawl is the
+        one that the search by branch_and_bound() alone finds.
+        """
+        from multiprocessing import Pool, Value, cpu_count
+        self.incumbent = float("inf")
+        self.incumbent_path = ()
+        self.budget = self.expanded + self.serial_nodes
+        try:
+            for product in self.branch_and_bound(self.IntervalNode(self, None, -1, None)):
+                if product is MaxIterationsReached:
+                    break
+            else:
+                return self.solutions[-1]
+        finally:
+            self.budget = None
+
+        processes = self.processes or cpu_count()
+        depth = min(2, len(self.list_intervals()) - 1)
+        branches = [()]
+        while len(branches[0]) < depth and len(branches) < processes * 4:
+            branches = [branch + (index,) for branch in branches for index in range(len(self.branch_children(self.branch_node(branch))))]
+
+        # each search has its own pool and incumbent, so searches never see each other's costs
+        incumbent = Value("d", self.incumbent)
+        pool = Pool(processes, share_incumbent, (incumbent,))
+        try:
+            results = pool.map(search_branch, [(self.notes, self.sustain, int(self.npo), self.max_octaves, branch) for branch in branches], 1)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        best = None
+        for cost, crawl_path, path, expanded in results:
+            self.expanded += expanded
+            if path is not None and (best is None or (cost, crawl_path) < best[:2]):
+                best = (cost, crawl_path, path)
+        errlog("Searched %i branches in %i processes." % (len(branches), processes))
+        return self.path_solution(best[2])
+
+    def completion(self, depth, fundamentals):
+        """
+        The least cost that the intervals from depth on add to a node with
+        the given fundamentals.
+
+        Only the fundamentals that later intervals could bring affect the
+        cost to come, so they alone make up the state that is memoized, and
+        each state is solved once however many paths reach it.
+        """
+        intervals = self.list_intervals()
+        if depth == len(intervals):
+            return 0
+        candidates, cheapest = self.fundamental_bounds()
+        state = (depth, frozenset(fundamental for fundamental in fundamentals if fundamental in cheapest[depth]))
+        if state in self.completions:
+            return self.completions[state]
+
+        self.expanded += 1
+        interval = intervals[depth]
+        best = None
+        for ratio in interval.ratios:
+            fundamental = self.harmonics.getHarmonicNote(ratio.d) - interval.bottom
+            if fundamental in state[1]:
+                cost = self.completion(depth + 1, state[1])
+            else:
+                cost = ratio.d + self.completion(depth + 1, state[1] | frozenset([fundamental]))
+            if best is None or cost < best:
+                best = cost
+        self.completions[state] = best
+        return best
+
+    def dynamic(self):
+        """
+        The cheapest solution by closest, taking from each node the first
+        child in the crawler's order through which completion() reaches the
+        node's least cost, so ties go to the solution that crawling the
+        whole graph would settle on.
+        """
+        node = self.IntervalNode(self, None, -1, None)
+        ratios = node.child_ratios()
+        while ratios is not None:
+            cost = self.completion(node.depth, node.fundamentals)
+            for child in node.child_nodes(ratios):
+                if child.cost - node.cost + self.completion(child.depth, child.fundamentals) == cost:
+                    break
+            node = child
+            ratios = node.child_ratios()
+        return self.Solution(node)
+
+    def path_solution(self, path):
+        "the Solution that takes the ratio at each index of path for each interval"
+        node = self.IntervalNode(self, None, -1, None)
+        for interval, index in zip(self.list_intervals(), path):
+            node.child_interval = interval
+            node = self.IntervalNode(self, node, node.depth, interval.ratios[index])
+        return self.Solution(node)
+
+    def crawl_tables(self):
+        """
+        The ratio graph as tables for crawl(), one entry for each interval.
+
+        Each fundamental that a ratio can bring is given a bit, and each
+        entry holds the bit and denominator of each ratio, the bit that
+        IntervalNode.child_ratios() looks for to put the ratio first, and
+        the sustained note below the interval's top and the ratio between
+        their pitches, or None.
+        """
+        intervals = self.list_intervals()
+        bits = {}
+        for interval in intervals:
+            for ratio in interval.ratios:
+                bits.setdefault(self.harmonics.getHarmonicNote(ratio.d) - interval.bottom, 1 << len(bits))
+
+        sustained = set(self.sustainMap) & set(self.notes)
+        sustain = [(note, self.sustainMap[note]) for note in sorted(self.notes) if note in sustained]
+        tables = []
+        for depth, interval in enumerate(intervals):
+            # child_ratios() measures the fundamentals from the bottom of the interval below
+            below = intervals[depth - 1].bottom if depth else None
+            sustain_below = None
+            if len(sustained) > 1 and interval.top in sustained:
+                for note, f in sustain:
+                    if note == interval.top:
+                        break
+                    sustain_below = (note, float(self.sustainMap[interval.top]) / f)
+            tables.append((
+                [(bits[self.harmonics.getHarmonicNote(ratio.d) - interval.bottom], ratio.d) for ratio in interval.ratios],
+                [bits.get(self.harmonics.getHarmonicNote(ratio.d) - below, 0) if depth else 0 for ratio in interval.ratios],
+                sustain_below,
+            ))
+        return tables
+
+    def crawl(self, step = 1000, max_i = 10000):
+        """
+        Crawl the ratio graph depth first, as the nested IntervalNode crawlers do.
+
+        The crawl keeps a stack of the index of the ratio taken at each
+        depth, and the fundamentals of each node on it as a bitmask and a
+        cost, so no node is made until a solution is.  It visits the
+        solutions in the same order, and yields in the same places, as the
+        nested crawl, keeping only the first of the cheapest so far.
+        """
+        intervals = self.list_intervals()
+        tables = self.crawl_tables()
+        last = len(intervals) - 1
+        masks = [0] * len(intervals)
+        costs = [0] * len(intervals)
+        orders = [None] * len(intervals)
+        positions = [0] * len(intervals)
+        path = [0] * len(intervals)
+
+        def order(depth):
+            "the indices of the ratios of the interval at depth, in the order IntervalNode.child_ratios() takes them"
+            self.expanded += 1
+            ratios = intervals[depth].ratios
+            bits, first_bits, sustain_below = tables[depth]
+            if sustain_below:
+                note, sustain_ratio = sustain_below
+                sustain_ratio_diff = 1.0
+                below = depth
+                while below >= 0 and intervals[below].top != note:
+                    if below:
+                        ratio = intervals[below - 1].ratios[path[below - 1]]
+                        sustain_ratio_diff = sustain_ratio_diff * ratio.n / ratio.d
+                    below -= 1
+                possible = [i for i, ratio in enumerate(ratios) if float(ratio.n) / ratio.d == sustain_ratio / sustain_ratio_diff]
+                return possible or range(len(ratios))
+            mask = masks[depth]
+            return [i for i, bit in enumerate(first_bits) if bit & mask] + [i for i, bit in enumerate(first_bits) if not bit & mask]
+
+        best_cost = None
+        best_path = None
+        reported = None
+        i = 0
+        depth = 0
+        orders[0] = order(0)
+        while depth >= 0:
+            if positions[depth] == len(orders[depth]):
+                depth -= 1
+                continue
+            index = orders[depth][positions[depth]]
+            positions[depth] += 1
+            path[depth] = index
+            bit, d = tables[depth][0][index]
+            mask, cost = masks[depth], costs[depth]
+            if not mask & bit:
+                mask |= bit
+                cost += d
+
+            if depth < last:
+                depth += 1
+                masks[depth], costs[depth], positions[depth] = mask, cost, 0
+                orders[depth] = order(depth)
+                continue
+
+            i += 1
+            if best_cost is None or cost < best_cost:
+                best_cost, best_path = cost, list(path)
+            if max_i and i > max_i:
+                yield MaxIterationsReached
+                break
+
+            if i % step == 0:
+                if verbose: errlog("Solutions searched: " + str(i))
+                if best_path is not reported:
+                    errlog("New solution found.")
+                    reported = best_path
+                    self.last_solution, self.solution = self.solution, self.path_solution(best_path)
+                    yield self.solution
+
+        if best_path is not reported:
+            errlog("New solution found.")
+            self.last_solution, self.solution = self.solution, self.path_solution(best_path)
+            yield self.solution
+
     _best_solution_cache = {}
     
     def producer(self, step = 1000, max_i = 10000):
@@ -804,11 +1225,35 @@ class Tuner:
             yield SearchComplete
             return
             
-        self.graph = self.Graph(self)
-        errlog("Solution tree initialized.")
+        search = self.search
+        if search == "dynamic" and len(set(self.sustainMap) & set(self.notes)) > 1:
+            # the sustained notes narrow the ratios by the ones chosen below
+            # them, which the states of completion() leave out
+            search = "bound"
+
+        if search == "best" or search == "dynamic" or search == "parallel":
+            self.solution = {"best": self.best_first, "dynamic": self.dynamic, "parallel": self.parallel_bound}[search]()
+            yield self.solution
+            yield SearchComplete
+            return
+
+        if search == "crawl":
+            for solution in self.crawl(step, max_i):
+                yield solution
+            yield SearchComplete
+            return
+
+        if search == "bound":
+            self.incumbent = float("inf")
+            self.incumbent_path = ()
+            iterator = self.branch_and_bound(self.IntervalNode(self, None, -1, None))
+        else:
+            self.graph = self.Graph(self)
+            errlog("Solution tree initialized.")
+            iterator = self.graph.iterator
        
         i = 0
-        for iteration in self.graph.iterator:
+        for iteration in iterator:
             i += 1
             if max_i and i > max_i:
                 yield MaxIterationsReached
@@ -836,4 +1281,5 @@ class Tuner:
                 errlog("Max iterations reached.")
             else:
                 if verbose: errlog("Best solution so far: " + str(solution))
+        errlog("Expanded %i nodes searching by %s." % (self.expanded, self.search))
 
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+Copyright Ben Woolley 2010.
+All rights reserved.
+"""
+
+import struct
+
+PCM = 1
+IEEE_FLOAT = 3
+
+def encode(values, sample_depth = 16, floating = False, dither = None):
+    """
+    Encode a block of floats in [-1.0, 1.0] as little-endian sample bytes.
+
+    Integer depths of 16, 24 and 32 bits are scaled to the full signed range
+    and rounded, after adding the triangular (TPDF) noise of one step from
+    dither when it is a numpy RandomState.  With floating the block is written
+    as 32 bit floats and neither scaled nor dithered.
+    """
+    import numpy
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if floating:
+        return values.astype("<f4").tobytes()
+
+    scale = float(2 ** (sample_depth - 1) - 1)
+    scaled = values * scale
+    if dither is not None:
+        scaled += dither.uniform(-0.5, 0.5, values.shape) + dither.uniform(-0.5, 0.5, values.shape)
+    signed = numpy.clip(numpy.rint(scaled), -scale - 1, scale).astype("<i4")
+
+    if sample_depth == 16:
+        return signed.astype("<i2").tobytes()
+    elif sample_depth == 24:
+        return signed.reshape(-1, 1).view(numpy.uint8)[:, :3].tobytes()
+    elif sample_depth == 32:
+        return signed.tobytes()
+    else:
+        raise ValueError("Sample depth must be 16, 24 or 32, not %i." % sample_depth)
+
+def decode(data, sample_depth = 16, floating = False):
+    "decode little-endian sample bytes written by encode() back to floats"
+    import numpy
+    if floating:
+        return numpy.frombuffer(data, dtype="<f4").astype(numpy.float64)
+
+    scale = float(2 ** (sample_depth - 1) - 1)
+    if sample_depth == 16:
+        signed = numpy.frombuffer(data, dtype="<i2")
+    elif sample_depth == 24:
+        # sign extend each three bytes through the top of a four byte word
+        padded = numpy.zeros((len(data) / 3, 4), dtype=numpy.uint8)
+        padded[:, 1:] = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3)
+        signed = padded.view("<i4")[:, 0] >> 8
+    elif sample_depth == 32:
+        signed = numpy.frombuffer(data, dtype="<i4")
+    else:
+        raise ValueError("Sample depth must be 16, 24 or 32, not %i." % sample_depth)
+    return signed / scale
+
+
+class WaveWriter:
+    """
+    Streams blocks into a RIFF/WAVE file.
+
+    The header is written up front with empty sizes and patched by close(),
+    so a file can be written in one pass without knowing its length.
+    """
+    max_size = 0xFFFFFFFF
+
+    def __init__(self, filename, sample_rate, channels = 2, sample_depth = 16, floating = False, dither = False, seed = 0):
+        import numpy
+        self.f = open(filename, "wb")
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_depth = 32 if floating else sample_depth
+        self.floating = floating
+        self.dither = numpy.random.RandomState(seed) if dither and not floating else None
+
+        self.frame_bytes = self.channels * self.sample_depth / 8
+        self.data_bytes = 0
+        self.write_header()
+        self.data_offset = self.f.tell()
+
+    def write_header(self):
+        self.f.seek(0)
+        frames = self.data_bytes / self.frame_bytes
+        fmt = struct.pack(
+            "<HHIIHH",
+            IEEE_FLOAT if self.floating else PCM,
+            self.channels,
+            self.sample_rate,
+            self.sample_rate * self.frame_bytes,
+            self.frame_bytes,
+            self.sample_depth,
+        )
+        if self.floating:
+            # non-PCM formats carry an extension size and a fact chunk
+            chunks = b"fmt " + struct.pack("<I", len(fmt) + 2) + fmt + struct.pack("<H", 0)
+            chunks += b"fact" + struct.pack("<II", 4, min(frames, self.max_size))
+        else:
+            chunks = b"fmt " + struct.pack("<I", len(fmt)) + fmt
+        chunks += b"data" + struct.pack("<I", min(self.data_bytes, self.max_size))
+
+        riff_bytes = 4 + len(chunks) + self.data_bytes + self.data_bytes % 2
+        self.f.write(b"RIFF" + struct.pack("<I", min(riff_bytes, self.max_size)) + b"WAVE" + chunks)
+
+    def write(self, values):
+        "write a block of floats, shaped (frames, channels) unless mono"
+        self.write_encoded(encode(values, self.sample_depth, self.floating, self.dither))
+
+    def write_encoded(self, block):
+        "write a block that is already encoded and interleaved"
+        self.f.write(block)
+        self.data_bytes += len(block)
+
+    def resize(self, frames):
+        "grow or shrink the data to frames, which a WaveMap can then fill in place"
+        self.data_bytes = frames * self.frame_bytes
+        self.f.truncate(self.data_offset + self.data_bytes)
+        self.write_header()
+        self.f.seek(0, 2)
+        self.f.flush()
+
+    def close(self):
+        if self.data_bytes % 2:
+            # chunks are word aligned
+            self.f.write(b"\0")
+        self.write_header()
+        self.f.close()
+
+
+class WaveReader:
+    """
+    Reads the samples of a RIFF/WAVE file as blocks of floats.
+
+    Only the formats that WaveWriter writes are understood, and chunks
+    other than the format and the data are passed over.
+    """
+
+    def __init__(self, filename):
+        self.f = open(filename, "rb")
+        riff, size, wave = struct.unpack("<4sI4s", self.f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise ValueError("%s is not a wave file." % filename)
+
+        while True:
+            header = self.f.read(8)
+            if len(header) < 8:
+                raise ValueError("%s has no data chunk." % filename)
+            name, size = struct.unpack("<4sI", header)
+            if name == b"data":
+                break
+            chunk = self.f.read(size + size % 2)
+            if name == b"fmt ":
+                format_tag, self.channels, self.sample_rate, rate_bytes, self.frame_bytes, self.sample_depth = struct.unpack("<HHIIHH", chunk[:16])
+                self.floating = format_tag == IEEE_FLOAT
+
+        self.frames = size / self.frame_bytes
+        self.position = 0
+
+    def read(self, frames):
+        "read up to frames frames, shaped (frames, channels); empty at the end"
+        frames = min(frames, self.frames - self.position)
+        self.position += frames
+        values = decode(self.f.read(frames * self.frame_bytes), self.sample_depth, self.floating)
+        return values.reshape(-1, self.channels)
+
+    def close(self):
+        self.f.close()
+
+
+class WaveMap:
+    """
+    Writes encoded frames in place into the data of a wave file.
+
+    The file is mapped into memory, so several processes can each fill in
+    their own frames of a file that WaveWriter.resize() has already grown
+    to its full length.  A block that runs past the end of the file grows
+    it, which only the process writing the last frames should do.
+    """
+
+    def __init__(self, filename, data_offset, frame_bytes):
+        import mmap
+        self.f = open(filename, "r+b")
+        self.data = mmap.mmap(self.f.fileno(), 0)
+        self.data_offset = data_offset
+        self.frame_bytes = frame_bytes
+
+    def write_encoded(self, frame, block):
+        "write a block that is already encoded and interleaved, from the given frame on"
+        import mmap
+        begin = self.data_offset + frame * self.frame_bytes
+        if begin + len(block) > len(self.data):
+            # not every platform can resize a map, so map the grown file afresh
+            self.data.flush()
+            self.data.close()
+            self.f.truncate(begin + len(block))
+            self.data = mmap.mmap(self.f.fileno(), 0)
+        self.data[begin:begin + len(block)] = block
+
+    def close(self):
+        self.data.flush()
+        self.data.close()
+        self.f.close()